@@ -38,7 +38,7 @@ import os
 import warnings
 import sys
 import time
-from .utils.checkpoint import save_checkpoint, load_checkpoint
+from .utils.checkpoint import save_checkpoint, load_checkpoint, poll_checkpoint, wait_for_checkpoint
 from . import mpu, print_rank_0
 
 # Name of the files used for checkpointing
@@ -286,6 +286,8 @@ def train(
 
             self.state.global_step += 1
             self.state.epoch = epoch + (step + 1) / num_steps_per_epoch
+            # Record the background checkpoint once every rank wrote it.
+            poll_checkpoint()
             self.control = self.callback_handler.on_step_end(args, self.state, self.control)
             self._maybe_log_save_evaluate(tr_loss, model, trial, epoch, ignore_keys_for_eval)
                 
@@ -302,6 +304,9 @@ def train(
         if self.control.should_training_stop:
             break
 
+    # Finish the last checkpoint written in the background.
+    wait_for_checkpoint()
+
     if args.past_index and hasattr(self, "_past"):
         # Clean the state at the end of training
         delattr(self, "_past")
@@ -17,10 +17,22 @@
 
 # Parts of the code here are adapted from https://github.com/NVIDIA/Megatron-LM/blob/v2.6/megatron/checkpointing.py
 
+import atexit
+import functools
+import inspect
+import io
+import json
+import mmap
+import pickle
 import random
+import struct
 import sys
 import os
+import threading
+import zipfile
 import numpy as np
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from numpy.lib import utils
 
 import torch
@@ -30,6 +42,35 @@ import torch.distributed as dist
 
 _CHECKPOINT_VERSION = None
 
+# Checkpoints are written to disk by a single background worker so that
+# training can resume as soon as the state has been staged in host memory.
+_CKPT_EXECUTOR = ThreadPoolExecutor(max_workers=1)
+_PENDING_FUTURE = None
+# (iteration, checkpoints_path) of the save that has not updated the tracker yet.
+_PENDING_TRACKER = None
+# Free pinned host buffers keyed by (dtype, nbytes), pinning memory is
+# expensive so the buffers are recycled across saves.
+_PINNED_POOL = {}
+_PINNED_POOL_LOCK = threading.Lock()
+# Tensor offsets in the raw model file are aligned to this many bytes.
+_FAST_ALIGNMENT = 64
+_ZERO_PAD = bytes(_FAST_ALIGNMENT)
+# Number of buffers handed to the kernel per vectored write.
+_WRITE_BATCH = 32
+# Integer dtypes by element size, viewing a tensor through one of them keeps
+# the element size, which torch 1.10 requires for Tensor.view(dtype).
+_SAME_WIDTH_INT = {1: torch.uint8, 2: torch.int16, 4: torch.int32, 8: torch.int64}
+
+# Arguments deciding which parameters end up in each checkpoint file.
+_CHECKPOINT_FIXED_ARGS = frozenset(['num_layers', 'shard_count', 'partition_method'])
+
+# Parallel ranks are constant once mpu is initialized, read them lazily.
+_PP_RANK = None
+_PP_WORLD = None
+_MP_RANK = None
+_DP_RANK = None
+_DP_WORLD = None
+
 def set_checkpoint_version(value):
     global _CHECKPOINT_VERSION
     if _CHECKPOINT_VERSION is not None:
@@ -41,58 +82,61 @@ def get_checkpoint_version():
     global _CHECKPOINT_VERSION
     return _CHECKPOINT_VERSION
 
+def _init_rank_cache():
+    """Read the parallel ranks once, they do not change after mpu init."""
+    global _PP_RANK, _PP_WORLD, _MP_RANK, _DP_RANK, _DP_WORLD
+    if _PP_WORLD is not None:
+        return
+    # The model parallel group of Merak is the tensor parallel slice.
+    _MP_RANK = mpu.get_model_parallel_rank()
+    _PP_RANK = mpu.get_pipe_parallel_rank()
+    _DP_RANK = mpu.get_data_parallel_rank()
+    _DP_WORLD = mpu.get_data_parallel_world_size()
+    _PP_WORLD = mpu.get_pipe_parallel_world_size()
+
+@functools.lru_cache(maxsize=32)
 def get_checkpoint_name(checkpoints_path, iteration,
                         release=False, complete=False):
     """A unified checkpoint name."""
+    _init_rank_cache()
     if release:
         directory = 'release'
     else:
         directory = 'iter_{:07d}'.format(iteration)
     # Use both the tensor and pipeline MP rank.
-    if mpu.get_pipe_parallel_world_size() == 1:
+    if _PP_WORLD == 1:
         if complete:
             return os.path.join(checkpoints_path,
                             'iter_{:07d}_mp_rank_{:02d}'.format(
-                                iteration,
-                                mpu.get_tensor_model_parallel_rank()),
+                                iteration, _MP_RANK),
                             'complete_model_optim.pt')
         return os.path.join(checkpoints_path, directory,
-                            'mp_rank_{:02d}'.format(
-                                mpu.get_tensor_model_parallel_rank()),
+                            'mp_rank_{:02d}'.format(_MP_RANK),
                             'model_optim_rng.pt')
     if complete:
         return os.path.join(checkpoints_path, directory,
                         'iter_{:07d}_mp_rank_{:02d}_pp_rank_{:03d}'.format(
-                            iteration,
-                            mpu.get_model_parallel_rank(),
-                            mpu.get_pipe_parallel_rank()),
+                            iteration, _MP_RANK, _PP_RANK),
                         'complete_model_optim.pt')
     return os.path.join(checkpoints_path, directory,
                         'mp_rank_{:02d}_pp_rank_{:03d}'.format(
-                            mpu.get_model_parallel_rank(),
-                            mpu.get_pipe_parallel_rank()),
+                            _MP_RANK, _PP_RANK),
                         'model_optim_rng.pt')
 
 def ensure_directory_exists(filename):
     """Build filename's path if it does not already exists."""
-    dirname = os.path.dirname(filename)
-    if not os.path.exists(dirname):
-        os.makedirs(dirname)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
 
 def check_checkpoint_args(checkpoint_args, args):
     """Ensure fixed arguments for a model are the same for the input
     arguments and the one retrieved from checkpoint."""
-
-    def _compare(arg_name, old_arg_name=None):
-        if old_arg_name is not None:
-            checkpoint_value = getattr(checkpoint_args, old_arg_name)
-        else:
-            checkpoint_value = getattr(checkpoint_args, arg_name)
-        args_value = getattr(args, arg_name)
-        error_message = '{} value from checkpoint ({}) is not equal to the ' \
-                        'input argument value ({}).'.format(
-                            arg_name, checkpoint_value, args_value)
-        assert checkpoint_value == args_value, error_message
+    checkpoint_values, arg_values = vars(checkpoint_args), vars(args)
+    names = checkpoint_values.keys() & arg_values.keys() & _CHECKPOINT_FIXED_ARGS
+    mismatches = [(name, checkpoint_values[name], arg_values[name])
+                  for name in names
+                  if checkpoint_values[name] != arg_values[name]]
+    assert not mismatches, 'values from checkpoint are not equal to the input ' \
+        'argument values, (name, checkpoint, input): {}'.format(mismatches)
 
 def get_checkpoint_tracker_filename(checkpoints_path):
     """Tracker file rescords the latest chckpoint during
@@ -100,9 +144,9 @@ def get_checkpoint_tracker_filename(checkpoints_path):
     return os.path.join(checkpoints_path, 'latest_checkpointed_iteration.txt')
 
 
-def read_metadata(tracker_filename):
-    # Read the tracker file and either set the iteration or
-    # mark it as a release checkpoint.
+def _read_tracker_file(tracker_filename):
+    """Parse the tracker file, return (iteration, release) or None
+    if the file is invalid."""
     iteration = 0
     release = False
     with open(tracker_filename, 'r') as f:
@@ -112,16 +156,25 @@ def read_metadata(tracker_filename):
         except ValueError:
             release = metastring == 'release'
             if not release:
-                print_rank_0('ERROR: Invalid metadata file {}. Exiting'.format(
-                    tracker_filename))
-                sys.exit()
-    assert iteration > 0 or release, 'error parsing metadata file {}'.format(
-        tracker_filename)
+                return None
+    if iteration <= 0 and not release:
+        return None
+    return iteration, release
+
+def _read_metadata_all_ranks(tracker_filename):
+    # Every rank reads the tracker file.
+    _init_rank_cache()
+    metadata = _read_tracker_file(tracker_filename)
+    if metadata is None:
+        print_rank_0('ERROR: Invalid metadata file {}. Exiting'.format(
+            tracker_filename))
+        sys.exit()
+    iteration, release = metadata
 
     # Get the max iteration retrieved across the ranks.
-    iters_cuda = torch.cuda.LongTensor([iteration])
+    iters_cuda = torch.tensor(iteration, device='cuda', dtype=torch.long)
     torch.distributed.all_reduce(iters_cuda, op=torch.distributed.ReduceOp.MAX)
-    max_iter = iters_cuda[0].item()
+    max_iter = iters_cuda.item()
 
     # We should now have all the same iteration.
     # If not, print a warning and chose the maximum
@@ -130,28 +183,385 @@ def read_metadata(tracker_filename):
         print('WARNING: on rank {} found iteration {} in the '
               'metadata while max iteration across the ranks '
               'is {}, replacing it with max iteration.'.format(
-                  mpu.get_pipe_parallel_rank(), iteration, max_iter), flush=True)
+                  _PP_RANK, iteration, max_iter), flush=True)
     return max_iter, release
 
+def read_metadata(tracker_filename, strict=False):
+    """Read the tracker file and either set the iteration or mark it as a
+    release checkpoint. Rank 0 reads the file and broadcasts it, with strict
+    every rank reads it and the maximum iteration across ranks is used."""
+    if strict:
+        return _read_metadata_all_ranks(tracker_filename)
+
+    iteration, release = -1, False
+    if torch.distributed.get_rank() == 0:
+        metadata = _read_tracker_file(tracker_filename)
+        if metadata is not None:
+            iteration, release = metadata
+    metadata_cuda = torch.tensor([iteration, int(release)],
+                                 device='cuda', dtype=torch.long)
+    torch.distributed.broadcast(metadata_cuda, src=0)
+    iteration, release = metadata_cuda.tolist()
+
+    if iteration < 0:
+        print_rank_0('ERROR: Invalid metadata file {}. Exiting'.format(
+            tracker_filename))
+        sys.exit()
+    return iteration, bool(release)
+
+def _acquire(dtype, nbytes):
+    """Get a flat pinned host buffer of nbytes from the pool."""
+    with _PINNED_POOL_LOCK:
+        buffers = _PINNED_POOL.get((dtype, nbytes))
+        if buffers:
+            return buffers.pop()
+    numel = nbytes // torch.empty(0, dtype=dtype).element_size()
+    return torch.empty(numel, dtype=dtype, pin_memory=torch.cuda.is_available())
+
+def _release(*buffers):
+    """Give buffers from _acquire back to the pool."""
+    with _PINNED_POOL_LOCK:
+        for buf in buffers:
+            key = (buf.dtype, buf.numel() * buf.element_size())
+            _PINNED_POOL.setdefault(key, []).append(buf)
+
+def _stage_to_host(state_dict):
+    """Copy every tensor of state_dict into pooled pinned host buffers,
+    so that the copy can be written to disk while training goes on.
+    Returns the staged state_dict and the buffers to release after the write."""
+    acquired = []
+
+    def _stage(obj):
+        if torch.is_tensor(obj):
+            buf = _acquire(obj.dtype, obj.numel() * obj.element_size())
+            acquired.append(buf)
+            staged = buf.view(obj.shape)
+            staged.copy_(obj.detach(), non_blocking=obj.is_cuda)
+            return staged
+        if isinstance(obj, dict):
+            staged = type(obj)((k, _stage(v)) for k, v in obj.items())
+            # Keep the module versions used by load_state_dict.
+            if hasattr(obj, '_metadata'):
+                staged._metadata = obj._metadata
+            return staged
+        if isinstance(obj, tuple) and hasattr(obj, '_fields'):
+            return type(obj)(*[_stage(v) for v in obj])
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(_stage(v) for v in obj)
+        return obj
+
+    staged = _stage(state_dict)
+    if torch.cuda.is_available():
+        torch.cuda.current_stream().synchronize()
+    return staged, acquired
+
+def _get_meta_name(checkpoint_name):
+    """Non-tensor payload stored next to the raw model file."""
+    return os.path.join(os.path.dirname(checkpoint_name), 'meta.pt')
+
+def _get_optimizer_name(checkpoint_name):
+    """Optimizer state stored next to the raw model file."""
+    return os.path.join(os.path.dirname(checkpoint_name), 'optim.pt')
+
+def _get_manifest_name(checkpoint_name):
+    """Map from parameter name to the data parallel shard holding it."""
+    return os.path.join(os.path.dirname(checkpoint_name), 'manifest.json')
+
+def _get_shard_name(checkpoint_name, dp_rank):
+    return '{}.rank{}.pt'.format(os.path.splitext(checkpoint_name)[0], dp_rank)
+
+def _shard_model_state_dict(model_state_dict, dp_rank, dp_world):
+    """Split the model round-robin over the sorted parameter names, so that
+    every data parallel rank agrees on the partition."""
+    owners = {name: idx % dp_world
+              for idx, name in enumerate(sorted(model_state_dict.keys()))}
+    shard = OrderedDict((name, tensor) for name, tensor in model_state_dict.items()
+                        if owners[name] == dp_rank)
+    if hasattr(model_state_dict, '_metadata'):
+        shard._metadata = model_state_dict._metadata
+    return shard, owners
+
+def _align(nbytes):
+    return (nbytes + _FAST_ALIGNMENT - 1) // _FAST_ALIGNMENT * _FAST_ALIGNMENT
+
+def _write_buffers(path, buffers):
+    """Write buffers back to back into path, issuing one vectored write per
+    _WRITE_BATCH buffers instead of a blocking write call per buffer."""
+    buffers = [memoryview(b).cast('B') for b in buffers if len(b) > 0]
+    if not hasattr(os, 'writev'):
+        with open(path, 'wb') as f:
+            for b in buffers:
+                f.write(b)
+        return
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        idx = 0
+        while idx < len(buffers):
+            written = os.writev(fd, buffers[idx:idx + _WRITE_BATCH])
+            # Skip what was written, the last buffer may be partially done.
+            while written > 0:
+                if written >= len(buffers[idx]):
+                    written -= len(buffers[idx])
+                    idx += 1
+                else:
+                    buffers[idx] = buffers[idx][written:]
+                    written = 0
+    finally:
+        os.close(fd)
+
+def _tensor_bytes(tensor):
+    """Raw bytes of tensor as a flat uint8 numpy array, without a copy for
+    contiguous cpu tensors."""
+    flat = tensor.detach().cpu().contiguous().reshape(-1)
+    int_dtype = _SAME_WIDTH_INT.get(flat.element_size())
+    if int_dtype is not None:
+        flat = flat.view(int_dtype)
+    return flat.numpy().view(np.uint8)
+
+def _save_fast(state_dict, path):
+    """Write state_dict['model'] as a pickled header followed by the raw bytes
+    of every tensor, everything else goes to meta.pt through torch.save.
+    The header maps name -> (shape, dtype, offset, nbytes)."""
+    model_state_dict = state_dict['model']
+    tensors = OrderedDict()
+    offset = 0
+    for name, tensor in model_state_dict.items():
+        nbytes = tensor.numel() * tensor.element_size()
+        tensors[name] = (tuple(tensor.shape), str(tensor.dtype), offset, nbytes)
+        offset = _align(offset + nbytes)
+    header = {'tensors': tensors,
+              'metadata': getattr(model_state_dict, '_metadata', None)}
+    header_bytes = pickle.dumps(header, protocol=pickle.HIGHEST_PROTOCOL)
+    data_start = _align(8 + len(header_bytes))
+
+    buffers = [struct.pack('<Q', len(header_bytes)), header_bytes]
+    position = 8 + len(header_bytes)
+    for name, tensor in model_state_dict.items():
+        _, _, offset, nbytes = tensors[name]
+        buffers.append(_ZERO_PAD[:data_start + offset - position])
+        if nbytes > 0:
+            buffers.append(_tensor_bytes(tensor))
+        position = data_start + offset + nbytes
+    _write_buffers(path, buffers)
+
+    if 'optimizer' in state_dict:
+        _save_with_oob(state_dict['optimizer'], _get_optimizer_name(path))
+
+    meta = {k: v for k, v in state_dict.items()
+            if k not in ('model', 'optimizer')}
+    if meta:
+        torch.save(meta, _get_meta_name(path))
+
+def _load_fast(path):
+    """Load a model state_dict written by _save_fast. Tensors are backed by a
+    copy-on-write mmap of the file, so pages are only read when touched."""
+    with open(path, 'rb') as f:
+        header_len, = struct.unpack('<Q', f.read(8))
+        header = pickle.loads(f.read(header_len))
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    data_start = _align(8 + header_len)
+
+    state_dict = OrderedDict()
+    for name, (shape, dtype, offset, nbytes) in header['tensors'].items():
+        dtype = getattr(torch, dtype.split('.')[-1])
+        if nbytes == 0:
+            state_dict[name] = torch.empty(shape, dtype=dtype)
+            continue
+        numel = nbytes // torch.empty(0, dtype=dtype).element_size()
+        state_dict[name] = torch.frombuffer(
+            buf, dtype=dtype, count=numel, offset=data_start + offset).view(shape)
+    if header['metadata'] is not None:
+        state_dict._metadata = header['metadata']
+    return state_dict
+
+def _rebuild_oob_tensor(buffer, dtype, shape):
+    dtype = getattr(torch, dtype.split('.')[-1])
+    if memoryview(buffer).nbytes == 0:
+        return torch.empty(shape, dtype=dtype)
+    return torch.frombuffer(buffer, dtype=dtype).view(shape)
+
+class _OOBPickler(pickle.Pickler):
+    """Pickle tensors as out-of-band buffers holding their raw bytes."""
+    def reducer_override(self, obj):
+        if torch.is_tensor(obj):
+            return _rebuild_oob_tensor, (pickle.PickleBuffer(_tensor_bytes(obj)),
+                                         str(obj.dtype), tuple(obj.shape))
+        return NotImplemented
+
+def _save_with_oob(obj, path):
+    """Pickle obj with protocol 5, the tensor storages are taken out of the
+    pickle stream and written after it as raw aligned buffers."""
+    buffers = []
+    stream = io.BytesIO()
+    _OOBPickler(stream, protocol=5, buffer_callback=buffers.append).dump(obj)
+    raws = [b.raw() for b in buffers]
+    payload = stream.getbuffer()
+
+    layout = []
+    offset = 0
+    for raw in raws:
+        layout.append((offset, raw.nbytes))
+        offset = _align(offset + raw.nbytes)
+    header = {'pickle_nbytes': payload.nbytes, 'layout': layout}
+    header_bytes = pickle.dumps(header, protocol=pickle.HIGHEST_PROTOCOL)
+    data_start = _align(8 + len(header_bytes) + payload.nbytes)
+
+    out = [struct.pack('<Q', len(header_bytes)), header_bytes, payload]
+    position = 8 + len(header_bytes) + payload.nbytes
+    for (offset, nbytes), raw in zip(layout, raws):
+        out.append(_ZERO_PAD[:data_start + offset - position])
+        out.append(raw)
+        position = data_start + offset + nbytes
+    _write_buffers(path, out)
+
+def _load_with_oob(path):
+    """Load an object written by _save_with_oob, tensors are backed by a
+    copy-on-write mmap of the file."""
+    with open(path, 'rb') as f:
+        header_len, = struct.unpack('<Q', f.read(8))
+        header = pickle.loads(f.read(header_len))
+        payload = f.read(header['pickle_nbytes'])
+        buf = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY))
+    data_start = _align(8 + header_len + header['pickle_nbytes'])
+    buffers = [buf[data_start + offset:data_start + offset + nbytes]
+               for offset, nbytes in header['layout']]
+    return pickle.loads(payload, buffers=buffers)
+
+def _torch_load(path):
+    """torch.load to cpu, memory-mapping the file when torch supports it
+    (>= 2.1, zipfile format) so tensors are only paged in when touched."""
+    kwargs = {'map_location': 'cpu'}
+    parameters = inspect.signature(torch.load).parameters
+    if 'weights_only' in parameters:
+        # Checkpoints hold the training arguments, not only tensors.
+        kwargs['weights_only'] = False
+    if 'mmap' in parameters and zipfile.is_zipfile(path):
+        kwargs['mmap'] = True
+    return torch.load(path, **kwargs)
+
+def _load_sharded(checkpoint_name):
+    """Gather the model state_dict from the shards listed in the manifest."""
+    with open(_get_manifest_name(checkpoint_name), 'r') as f:
+        manifest = json.load(f)
+    directory = os.path.dirname(checkpoint_name)
+    shards = {}
+    state_dict = OrderedDict()
+    for name, shard_file in manifest['params'].items():
+        if shard_file not in shards:
+            shards[shard_file] = _load_fast(os.path.join(directory, shard_file))
+        state_dict[name] = shards[shard_file][name]
+    metadata = getattr(shards.get(manifest['shards'][0]), '_metadata', None)
+    if metadata is not None:
+        state_dict._metadata = metadata
+    return state_dict
+
+def _do_write(state_dict, checkpoint_name, dp_rank, manifest, staging_buffers):
+    try:
+        ensure_directory_exists(checkpoint_name)
+        _save_fast(state_dict, _get_shard_name(checkpoint_name, dp_rank))
+        if manifest is not None:
+            with open(_get_manifest_name(checkpoint_name), 'w') as f:
+                json.dump(manifest, f)
+    finally:
+        # Back to the pool before the future completes, so the next save
+        # always finds them.
+        _release(*staging_buffers)
+
+def _drain_checkpoint_writes():
+    """Block until the background checkpoint write has finished."""
+    global _PENDING_FUTURE
+    if _PENDING_FUTURE is not None:
+        future, _PENDING_FUTURE = _PENDING_FUTURE, None
+        future.result()
+
+atexit.register(_drain_checkpoint_writes)
+
+def wait_for_checkpoint():
+    """Wait for the in-flight checkpoint on all ranks and update the tracker
+    file. Must be called by every rank, like save_checkpoint."""
+    global _PENDING_TRACKER
+    if _PENDING_TRACKER is None:
+        return
+    iteration, checkpoints_path = _PENDING_TRACKER
+    _PENDING_TRACKER = None
+    _drain_checkpoint_writes()
+
+    # Wait so everyone is done (necessary)
+    if torch.distributed.is_initialized():
+        torch.distributed.barrier()
+
+    print_rank_0('  successfully saved checkpoint at iteration {:7d} to {}'.format(
+        iteration, checkpoints_path))
+
+    # And update the latest iteration. The tracker is replaced atomically,
+    # readers see either the old or the new iteration, so the other ranks
+    # do not need to wait for it.
+    if not torch.distributed.is_initialized() or torch.distributed.get_rank() == 0:
+        tracker_filename = get_checkpoint_tracker_filename(checkpoints_path)
+        tmp_filename = tracker_filename + '.tmp'
+        with open(tmp_filename, 'w') as f:
+            f.write(str(iteration))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_filename, tracker_filename)
+
+def poll_checkpoint():
+    """Update the tracker file as soon as the in-flight checkpoint is on disk
+    on every rank, without blocking otherwise. Meant to be called from the
+    training loop on every rank, a single-integer all-reduce is issued only
+    while a checkpoint is pending."""
+    if _PENDING_TRACKER is None:
+        return
+    done = _PENDING_FUTURE is None or _PENDING_FUTURE.done()
+    if torch.distributed.is_initialized():
+        done_cuda = torch.tensor(int(done), device='cuda', dtype=torch.long)
+        torch.distributed.all_reduce(done_cuda, op=torch.distributed.ReduceOp.MIN)
+        done = bool(done_cuda.item())
+    if done:
+        wait_for_checkpoint()
+
 def save_checkpoint(iteration, model, optimizer, lr_scheduler, args, epoch):
-    """Save a model checkpoint."""
+    """Save a model checkpoint.
+    The state is staged in host memory and written by a background thread,
+    call wait_for_checkpoint to make sure the checkpoint is complete."""
+    global _PENDING_FUTURE, _PENDING_TRACKER
+
+    # Never overlap two saves.
+    wait_for_checkpoint()
 
-    # Only rank zero of the data parallel writes to the disk.
     model = unwrap_model(model)
 
     print_rank_0('saving checkpoint at iteration {:7d} to {}'.format(
         iteration, args.output_dir+'/ckpt'))
 
-    if not torch.distributed.is_initialized() or mpu.get_data_parallel_rank() == 0:
+    # Every data parallel rank writes a shard of the model, rank zero of
+    # the data parallel also writes the rest of the state and the manifest.
+    if torch.distributed.is_initialized():
+        _init_rank_cache()
+        dp_rank, dp_world = _DP_RANK, _DP_WORLD
+    else:
+        dp_rank, dp_world = 0, 1
+    checkpoint_name = get_checkpoint_name(args.output_dir+'/ckpt', iteration)
+    model_state_dict = model.state_dict()
+    shard, owners = _shard_model_state_dict(model_state_dict, dp_rank, dp_world)
+
+    # Arguments, iteration, and model.
+    state_dict = {}
+    state_dict['model'] = shard
+    manifest = None
 
-        # Arguments, iteration, and model.
-        state_dict = {}
+    if dp_rank == 0:
         state_dict['args'] = args
         state_dict['checkpoint_version'] = 3.0
         state_dict['iteration'] = iteration
-        state_dict['model'] = model.state_dict()
         state_dict['epoch'] = epoch
 
+        shard_files = [os.path.basename(_get_shard_name(checkpoint_name, rank))
+                       for rank in range(dp_world)]
+        manifest = {'shards': shard_files,
+                    'params': {name: shard_files[owners[name]]
+                               for name in model_state_dict.keys()}}
+
         # Optimizer stuff.
         if not args.no_save_optim:
             if optimizer is not None:
@@ -159,14 +569,22 @@ def save_checkpoint(iteration, model, optimizer, lr_scheduler, args, epoch):
             if lr_scheduler is not None:
                 state_dict['lr_scheduler'] = lr_scheduler.state_dict()
 
-        # RNG states.
+        # RNG states, fetched concurrently. The current device is per
+        # thread, so the cuda state is read from this thread's device.
         if not args.no_save_rng:
-            state_dict['random_rng_state'] = random.getstate()
-            state_dict['np_rng_state'] = np.random.get_state()
-            state_dict['torch_rng_state'] = torch.get_rng_state()
-            state_dict['cuda_rng_state'] = torch.cuda.get_rng_state()
-            state_dict['rng_tracker_states'] \
-                = get_cuda_rng_tracker().get_states()
+            rng_getters = [
+                ('random_rng_state', random.getstate),
+                ('np_rng_state', functools.partial(np.random.get_state,
+                                                   legacy=False)),
+                ('torch_rng_state', torch.get_rng_state),
+                ('cuda_rng_state', functools.partial(
+                    torch.cuda.get_rng_state, torch.cuda.current_device())),
+                ('rng_tracker_states', get_cuda_rng_tracker().get_states),
+            ]
+            with ThreadPoolExecutor(max_workers=len(rng_getters)) as executor:
+                futures = {k: executor.submit(fn) for k, fn in rng_getters}
+            for k, future in futures.items():
+                state_dict[k] = future.result()
 
         # save a complete model
         # comp_model = {}
@@ -176,27 +594,13 @@ def save_checkpoint(iteration, model, optimizer, lr_scheduler, args, epoch):
         # ensure_directory_exists(check_name)
         # torch.save(comp_model, check_name, _use_new_zipfile_serialization=False)
 
-        # Save.
-        checkpoint_name = get_checkpoint_name(args.output_dir+'/ckpt', iteration)
-        ensure_directory_exists(checkpoint_name)
-        torch.save(state_dict, checkpoint_name, _use_new_zipfile_serialization=False)
+    # Stage to host memory and save in the background.
+    staged_state_dict, staging_buffers = _stage_to_host(state_dict)
+    _PENDING_FUTURE = _CKPT_EXECUTOR.submit(
+        _do_write, staged_state_dict, checkpoint_name, dp_rank, manifest,
+        staging_buffers)
 
-    # Wait so everyone is done (necessary)
-    if torch.distributed.is_initialized():
-        torch.distributed.barrier()
-
-    print_rank_0('  successfully saved checkpoint at iteration {:7d} to {}'.format(
-        iteration, args.output_dir+'/ckpt'))
-
-    # And update the latest iteration
-    if not torch.distributed.is_initialized() or torch.distributed.get_rank() == 0:
-        tracker_filename = get_checkpoint_tracker_filename(args.output_dir+'/ckpt')
-        with open(tracker_filename, 'w') as f:
-            f.write(str(iteration))
-
-    # Wait so everyone is done (not necessary)
-    if torch.distributed.is_initialized():
-        torch.distributed.barrier()
+    _PENDING_TRACKER = (iteration, args.output_dir+'/ckpt')
 
 
 def load_checkpoint(model, optimizer, lr_scheduler, args, load_arg='load', strict=True):
@@ -204,8 +608,13 @@ def load_checkpoint(model, optimizer, lr_scheduler, args, load_arg='load', stric
     strict (bool): whether to strictly enforce that the keys in
         :attr:`state_dict` of the checkpoint match the names of
         parameters and buffers in model.
+    Build the model on device='meta' to avoid allocating the parameters
+    twice, they are then assigned from the memory-mapped checkpoint.
     """
 
+    # Make sure a checkpoint saved by this process is complete.
+    wait_for_checkpoint()
+
     load_dir = args.resume_from_checkpoint #getattr(args, load_arg)
     model = unwrap_model(model)
 
@@ -222,16 +631,23 @@ def load_checkpoint(model, optimizer, lr_scheduler, args, load_arg='load', stric
 
     # Otherwise, read the tracker file and either set the iteration or
     # mark it as a release checkpoint.
-    iteration, release = read_metadata(tracker_filename)
+    iteration, release = read_metadata(tracker_filename,
+                                       strict=args.strict_metadata_check)
 
     # Checkpoint.
     checkpoint_name = get_checkpoint_name(load_dir, iteration, release)
     print_rank_0(f' loading checkpoint from {args.resume_from_checkpoint} at iteration {iteration}')
 
-    # Load the checkpoint.
+    # Load the checkpoint. For sharded checkpoints only the small meta.pt
+    # is read here, the model and optimizer follow once the args are checked.
     print(checkpoint_name)
+    sharded = os.path.isfile(_get_manifest_name(checkpoint_name))
     try:
-        state_dict = torch.load(checkpoint_name, map_location='cpu')
+        if sharded:
+            state_dict = _torch_load(_get_meta_name(checkpoint_name))
+        else:
+            # Checkpoints saved as a single torch.save file.
+            state_dict = _torch_load(checkpoint_name)
     except BaseException as e:
         print_rank_0('could not load the checkpoint')
         print_rank_0(e)
@@ -272,8 +688,21 @@ def load_checkpoint(model, optimizer, lr_scheduler, args, load_arg='load', stric
     else:
         print_rank_0('could not find arguments in the checkpoint ...')
 
-    # Model.
-    model.load_state_dict(state_dict['model'], strict=strict)
+    if sharded:
+        try:
+            state_dict['model'] = _load_sharded(checkpoint_name)
+        except BaseException as e:
+            print_rank_0('could not load the checkpoint')
+            print_rank_0(e)
+            sys.exit()
+
+    # Model. A model built on the meta device takes the memory-mapped
+    # tensors as its parameters instead of copying them (torch >= 2.1).
+    if any(p.is_meta for p in model.parameters()) and \
+            'assign' in inspect.signature(model.load_state_dict).parameters:
+        model.load_state_dict(state_dict['model'], strict=strict, assign=True)
+    else:
+        model.load_state_dict(state_dict['model'], strict=strict)
 
     # Fix up query/key/value matrix ordering if needed
     checkpoint_version = get_checkpoint_version()
@@ -282,6 +711,9 @@ def load_checkpoint(model, optimizer, lr_scheduler, args, load_arg='load', stric
 
     # Optimizer.
     if not release and not args.finetune and not args.no_load_optim:
+        optimizer_name = _get_optimizer_name(checkpoint_name)
+        if sharded and optimizer is not None and os.path.isfile(optimizer_name):
+            state_dict['optimizer'] = _load_with_oob(optimizer_name)
         try:
             if optimizer is not None:
                 optimizer.load_state_dict(state_dict['optimizer'])
@@ -298,6 +730,7 @@ def load_checkpoint(model, optimizer, lr_scheduler, args, load_arg='load', stric
     if not release and not args.finetune and not args.no_load_rng:
         try:
             random.setstate(state_dict['random_rng_state'])
+            # Accepts both the legacy tuple and the bit generator dict.
             np.random.set_state(state_dict['np_rng_state'])
             torch.set_rng_state(state_dict['torch_rng_state'])
             torch.cuda.set_rng_state(state_dict['cuda_rng_state'])
@@ -324,13 +757,5 @@ def load_checkpoint(model, optimizer, lr_scheduler, args, load_arg='load', stric
 
 
 def unwrap_model(model):
-    return_list = True
-    if not isinstance(model, list):
-        model = [model]
-        return_list = False
-    unwrapped_model = []
-    for model_module in model:
-        unwrapped_model.append(model_module)
-    if not return_list:
-        return unwrapped_model[0]
-    return unwrapped_model
\ No newline at end of file
+    # Models are not wrapped (e.g. by DDP) in Merak, return them as they are.
+    return model
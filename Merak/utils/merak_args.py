@@ -119,6 +119,7 @@ class MerakArguments(TrainingArguments):
     -   no_save_optim (bool, defaults to False) -- Do not save current optimizer.
     -   no_load_rng (bool, defaults to False) -- Do not load current optimizer.
     -   no_load_optim (bool, defaults to False) -- Do not load current optimizer.
+    -   strict_metadata_check (bool, defaults to False) -- Read the checkpoint tracker file on every rank and use the maximum iteration across ranks.
     -   split_inputs (bool, defaults to False) -- Whether to split input data.
     -   activation_checkpoint_ratio (float, Optional, defaults to None) -- activation checkpoint ratio of first stage, in range(0,1). Default to None.
     -   tp_overlapping_level (float, Optional, defaults to 0) -- "Possible tensor parallelism communication overlapping level from 0 to 3."
@@ -224,6 +225,10 @@ class MerakArguments(TrainingArguments):
         default=True,
         metadata={"help": "Do not load rng state when loading checkpoint."}
     )
+    strict_metadata_check: bool = field(
+        default=False,
+        metadata={"help": "Read the checkpoint tracker file on every rank and use the maximum iteration across ranks."}
+    )
 
     # split input
     split_inputs: bool = field(